@@ -2,39 +2,61 @@
 """
 Asana Outlook Integration Script
 
-Dependencies:
-  pip install msal requests asana
+Dependencies (see requirements.txt):
+  pip install msal requests asana orjson tenacity numpy python-dotenv colorama
 """
 import os
+import atexit
 import time
 import sys
 import msal
+import numpy as np
+import orjson
 import requests
 import logging
 import random
 import threading
+import functools
 import io
+import mmap
+import math
+import struct
+import hashlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import base64
+import json
+import html
+import re
+import sqlite3
+from urllib.parse import urlencode, quote
 import traceback
-from bs4 import BeautifulSoup
-import ast
 from dotenv import load_dotenv
 from colorama import init as _colorama_init, Fore
 try:
     import asana
 except ImportError:
     sys.exit("ERROR: Missing dependency 'asana'. Please install via 'pip install asana'")
-from requests.exceptions import HTTPError
+from requests.adapters import HTTPAdapter
+from requests.auth import AuthBase
+from requests.exceptions import ChunkedEncodingError, HTTPError
+from urllib3.util.retry import Retry
+from tenacity import (
+    before_sleep_log, retry, retry_if_exception, stop_after_attempt,
+    wait_exponential, wait_exponential_jitter,
+)
 
 # load environment variables and configure logging
 ENV_FILE = os.getenv("ENV_FILE", ".env")
 load_dotenv(ENV_FILE)
+# LOG_LEVEL=DEBUG dumps every message body, so it is opt-in
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
 logging.basicConfig(
-    level=logging.DEBUG,
+    level=LOG_LEVEL,
     format='[%(asctime)s] [%(levelname)s] %(name)s: %(message)s',
     handlers=[logging.StreamHandler(sys.stdout)]
 )
 logger = logging.getLogger(__name__)
-logger.setLevel(logging.DEBUG)
+logger.setLevel(LOG_LEVEL)
 
 # ------------------------------------------------------------
 # CONFIGURATION — EDIT THESE VALUES
@@ -43,21 +65,32 @@ TENANT_ID             = os.getenv("TENANT_ID")
 CLIENT_ID             = os.getenv("CLIENT_ID")
 CLIENT_SECRET         = os.getenv("CLIENT_SECRET")
 SCOPES                = ["https://graph.microsoft.com/.default"]
+TOKEN_CACHE_FILE      = ".msal_cache"
 
 MAIL_USER             = os.getenv("MAIL_USER")
-MAIL_FOLDER_PATH      = ast.literal_eval(os.getenv("MAIL_FOLDER_PATH", "[]"))
+MAIL_FOLDER_PATH      = json.loads(os.getenv("MAIL_FOLDER_PATH", "[]"))
 
 ASANA_PAT             = os.getenv("ASANA_PAT")
 ASANA_WORKSPACE_GID   = os.getenv("ASANA_WORKSPACE_GID")
 ASANA_PROJECT_GID     = os.getenv("ASANA_PROJECT_GID")
 ASANA_SECTION_GID     = os.getenv("ASANA_SECTION_GID")
+ASANA_VERIFY          = os.getenv("ASANA_VERIFY") == "1"  # look up the PAT's user at startup
 BUDGET_SECTION_GID    = os.getenv("BUDGET_SECTION_GID")
 QUOTE_SECTION_GID     = os.getenv("QUOTE_SECTION_GID")
 ORDER_SECTION_GID     = os.getenv("ORDER_SECTION_GID")
 
-PROCESSED_IDS_FILE    = "processed_ids.txt"
-TEMP_DIR              = "temp_attachments"
-SLEEP_INTERVAL        = 0.5  # seconds between operations
+PROCESSED_DB_FILE     = "processed.db"
+PROCESSED_IDS_FILE    = "processed_ids.txt"  # legacy log, imported into the DB once
+PROCESSED_BLOOM_FILE  = "processed.bloom"    # mmap'd Bloom filter over the DB's IDs
+BLOOM_CAPACITY        = 1_000_000            # expected processed IDs
+BLOOM_ERROR_RATE      = 1e-7                 # false-positive rate at capacity
+RUN_LOG_FILE          = "run.log"            # captured stdout/stderr of a run
+SYNC_STATE_FILE       = "state.json"         # Graph delta links and folder tree
+FOLDER_CACHE_FILE     = ".folder_cache.json" # resolved MAIL_FOLDER_PATH ids
+MAX_WORKERS           = 12   # messages processed concurrently
+ASANA_RATE_LIMIT      = 150  # Asana requests per minute, across all workers
+ASANA_UPLOAD_SLOTS    = 4    # attachment uploads in flight at once
+GRAPH_MAILBOX_SLOTS   = 4    # Outlook allows 4 concurrent requests per mailbox
 
 LOCATION_FIELD_GID    = os.getenv("LOCATION_FIELD_GID")
 JOB_NUMBER_FIELD_GID  = os.getenv("JOB_NUMBER_FIELD_GID")
@@ -73,88 +106,674 @@ if not all(required_vars):
 
 GRAPH_BASE = "https://graph.microsoft.com/v1.0"
 
+# subject keyword -> section, checked in order; unset sections are dropped
+ROUTES = tuple(
+    (token, gid)
+    for token, gid in (
+        ("budget", BUDGET_SECTION_GID),
+        ("quotation", QUOTE_SECTION_GID),
+        ("order confirmation", ORDER_SECTION_GID),
+    )
+    if gid
+)
+GRAPH_BATCH_LIMIT = 20  # max sub-requests per Graph $batch call
+GRAPH_BATCH_RETRIES = 5  # rounds for resending throttled sub-requests
+MESSAGE_FIELDS = "id,subject,body,receivedDateTime,from"
+# attachment metadata only (no contentBytes); @odata.type comes implicitly
+ATTACHMENT_EXPAND = "attachments($select=id,name,size)"
+TEXT_BODY_HEADERS = {"Prefer": 'outlook.body-content-type="text"'}
+# HTML-to-text for the rare body that still arrives as HTML
+_HTML_PREFIX_RE = re.compile(r"\s*<")
+_SCRIPT_STYLE_RE = re.compile(r"<(script|style)\b.*?</\1\s*>", re.IGNORECASE | re.DOTALL)
+_TAG_RE = re.compile(r"<[^>]+>")
+FOLDER_DELTA_URL = (
+    f"{GRAPH_BASE}/users/{MAIL_USER}/mailFolders/delta?$select=displayName,parentFolderId"
+)
+# the folder delta pages 10 at a time unless asked for more
+FOLDER_DELTA_HEADERS = {"Prefer": "odata.maxpagesize=250"}
+MAX_ATTACHMENT_SIZE = 3 * 1024 * 1024
+# attachments above this are streamed on their own rather than inlined
+# (base64, a third larger) in a $batch response
+BATCH_ATTACHMENT_SIZE = 512 * 1024
+
+# One pooled, keep-alive session for every Graph call; the bearer token is
+# attached per request by _GraphAuth (below) so it can be refreshed mid-run.
+SESSION = requests.Session()
+_adapter = HTTPAdapter(
+    pool_connections=16,
+    pool_maxsize=32,
+    # POST is retried too: our only POST is $batch, which carries GETs alone
+    max_retries=Retry(
+        total=8,
+        backoff_factor=0.5,
+        status_forcelist=(429, 500, 502, 503, 504),
+        respect_retry_after_header=True,
+        allowed_methods=("GET", "POST", "PUT", "DELETE"),
+        # hand back the last response once retries run out, so callers see
+        # an HTTPError (status and Retry-After intact) from raise_for_status
+        raise_on_status=False,
+    ),
+)
+SESSION.mount("https://", _adapter)
+SESSION.mount("http://", _adapter)
+
+
+class RateLimiter:
+    """Token bucket shared by worker threads to stay under an API quota."""
+
+    def __init__(self, rate_per_minute, burst=10):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, n=1):
+        """Block until ``n`` requests may be issued."""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= n:
+                    self.tokens -= n
+                    return
+                wait = (n - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+ASANA_LIMITER = RateLimiter(ASANA_RATE_LIMIT)
+_upload_slots = threading.BoundedSemaphore(ASANA_UPLOAD_SLOTS)
+# one pool for every message's attachment transfers, so a message's files
+# move in parallel without each worker spawning threads of its own
+_attachment_pool = ThreadPoolExecutor(max_workers=ASANA_UPLOAD_SLOTS, thread_name_prefix="attach")
+_mailbox_slots = threading.BoundedSemaphore(GRAPH_MAILBOX_SLOTS)
+
+
+def _is_throttled(exc):
+    # asana.rest.ApiException exposes .status, requests' HTTPError .response
+    status = getattr(exc, "status", None)
+    if status is None:
+        status = getattr(getattr(exc, "response", None), "status_code", None)
+    return status == 429
+
+
+def _is_transient(exc):
+    """Dropped connections, truncated bodies, and 429/5xx responses.
+
+    SESSION's urllib3 Retry returns the last 429/5xx response once its own
+    attempts run out; raise_for_status turns that into an HTTPError whose
+    response (and Retry-After header) is checked here.
+    """
+    if isinstance(exc, (requests.ConnectionError, requests.Timeout, ChunkedEncodingError)):
+        return True
+    status = getattr(getattr(exc, "response", None), "status_code", None) or 0
+    return status == 429 or status >= 500
+
+
+_backoff = wait_exponential(multiplier=1, max=30)
+_jittered_backoff = wait_exponential_jitter(initial=1, max=60)
+
+
+def _retry_after(retry_state):
+    """Seconds the failed call's Retry-After header asks for, or None."""
+    exc = retry_state.outcome.exception()
+    headers = getattr(exc, "headers", None)
+    if headers is None:
+        headers = getattr(getattr(exc, "response", None), "headers", None)
+    try:
+        return float((headers or {}).get("Retry-After"))
+    except (TypeError, ValueError):
+        return None
+
+
+def _wait_retry_after(retry_state):
+    """Wait exactly as long as the server's Retry-After asks, else back off."""
+    delay = _retry_after(retry_state)
+    return _backoff(retry_state) if delay is None else delay
+
+
+def _wait_graph(retry_state):
+    delay = _retry_after(retry_state)
+    return _jittered_backoff(retry_state) if delay is None else delay
+
+
+# Retries only throttled (429) calls, so an unthrottled run never waits.
+throttle_retry = retry(
+    retry=retry_if_exception(_is_throttled),
+    wait=_wait_retry_after,
+    stop=stop_after_attempt(5),
+    reraise=True,
+)
+
+# Outer retry for Graph calls: SESSION's urllib3 Retry covers status codes
+# at the transport, this also covers failures while reading a body.
+graph_retry = retry(
+    retry=retry_if_exception(_is_transient),
+    wait=_wait_graph,
+    stop=stop_after_attempt(5),
+    before_sleep=before_sleep_log(logger, logging.WARNING),
+    reraise=True,
+)
+
+
+_token_lock = threading.Lock()
+_token = {"value": None, "expires_at": 0.0}
+
 
 def get_access_token():
-    app = msal.ConfidentialClientApplication(
-        CLIENT_ID,
-        authority=f"https://login.microsoftonline.com/{TENANT_ID}",
-        client_credential=CLIENT_SECRET
+    """Return a Graph token, refreshing it 5 minutes before it expires.
+
+    The token is shared by all worker threads, and MSAL's cache is persisted
+    to TOKEN_CACHE_FILE so a run started within its lifetime skips AAD.
+    """
+    with _token_lock:
+        if _token["value"] and time.time() < _token["expires_at"] - 300:
+            return _token["value"]
+
+        cache = msal.SerializableTokenCache()
+        if os.path.exists(TOKEN_CACHE_FILE):
+            with open(TOKEN_CACHE_FILE, "r", encoding="utf-8") as f:
+                cache.deserialize(f.read())
+        app = msal.ConfidentialClientApplication(
+            CLIENT_ID,
+            authority=f"https://login.microsoftonline.com/{TENANT_ID}",
+            client_credential=CLIENT_SECRET,
+            token_cache=cache,
+        )
+        result = (
+            app.acquire_token_silent(SCOPES, account=None)
+            or app.acquire_token_for_client(scopes=SCOPES)
+        )
+        if "access_token" not in result:
+            raise Exception(f"Token error: {result.get('error_description')}")
+        if cache.has_state_changed:
+            fd = os.open(TOKEN_CACHE_FILE, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                f.write(cache.serialize())
+
+        _token["value"] = result["access_token"]
+        _token["expires_at"] = time.time() + int(result.get("expires_in", 0))
+        logger.info("[Graph] Acquired access token")
+        return _token["value"]
+
+
+class _GraphAuth(AuthBase):
+    """Attach the current Graph bearer token to each SESSION request."""
+
+    def __call__(self, r):
+        r.headers["Authorization"] = f"Bearer {get_access_token()}"
+        return r
+
+
+SESSION.auth = _GraphAuth()
+
+
+def _sub_retry_after(sub, attempt):
+    """Seconds a throttled $batch sub-response asks us to wait."""
+    try:
+        return float((sub.get("headers") or {}).get("Retry-After"))
+    except (TypeError, ValueError):
+        return min(2 ** attempt, 30)
+
+
+@graph_retry
+def graph_batch(requests_list):
+    """POST GET sub-requests to Graph's JSON $batch endpoint.
+
+    ``requests_list`` holds ``{"id": ..., "method": ..., "url": ...}`` dicts
+    with URLs relative to ``GRAPH_BASE``; they are sent in chunks of
+    ``GRAPH_BATCH_LIMIT``. Sub-requests throttled with a 429 (Outlook allows
+    only a few concurrent requests per mailbox) are resent in a later round
+    after their Retry-After. Returns the sub-responses keyed by request id.
+    """
+    responses = {}
+    pending = list(requests_list)
+    for attempt in range(GRAPH_BATCH_RETRIES + 1):
+        throttled, wait = [], 0.0
+        for start in range(0, len(pending), GRAPH_BATCH_LIMIT):
+            chunk = pending[start:start + GRAPH_BATCH_LIMIT]
+            with _mailbox_slots:
+                resp = SESSION.post(
+                    f"{GRAPH_BASE}/$batch",
+                    data=orjson.dumps({"requests": chunk}),
+                    headers={"Content-Type": "application/json"},
+                )
+            resp.raise_for_status()
+            for sub in orjson.loads(resp.content).get("responses", []):
+                if sub.get("status") == 429 and attempt < GRAPH_BATCH_RETRIES:
+                    throttled.append(sub["id"])
+                    wait = max(wait, _sub_retry_after(sub, attempt))
+                else:
+                    responses[sub["id"]] = sub
+        if not throttled:
+            break
+        logger.debug("Graph throttled %d batch sub-requests; retrying in %.1fs",
+                     len(throttled), wait)
+        by_id = {r["id"]: r for r in pending}
+        pending = [by_id[i] for i in throttled]
+        time.sleep(wait)
+    return responses
+
+
+def fetch_messages(msg_ids):
+    """Fetch full payloads for ``msg_ids`` through Graph $batch.
+
+    Bodies are requested as plain text and attachment metadata is expanded
+    inline, so no per-message attachment listing is needed. Returns
+    ``{msg_id: message}`` for every sub-request that succeeded; failures are
+    logged and left out.
+    """
+    batch = [
+        {
+            "id": str(i),
+            "method": "GET",
+            "url": f"/users/{MAIL_USER}/messages/{mid}?$select={MESSAGE_FIELDS}&$expand={ATTACHMENT_EXPAND}",
+            "headers": TEXT_BODY_HEADERS,
+        }
+        for i, mid in enumerate(msg_ids)
+    ]
+    messages = {}
+    for req_id, sub in graph_batch(batch).items():
+        mid = msg_ids[int(req_id)]
+        if sub.get("status", 500) >= 400:
+            logger.error("Failed to fetch message %s (%s): %s", mid, sub.get("status"), sub.get("body"))
+            continue
+        messages[mid] = sub.get("body", {})
+    return messages
+
+
+def _relative(url):
+    """Strip GRAPH_BASE so a nextLink can be used as a $batch sub-request URL."""
+    return url[len(GRAPH_BASE):] if url.startswith(GRAPH_BASE) else url
+
+
+@graph_retry
+def walk_folders(base_fid, base_path, folder_state):
+    """Map every folder under ``base_fid`` (inclusive) to its displayName path.
+
+    The mailbox hierarchy is kept in ``folder_state`` (part of the sync
+    state) as a parentFolderId -> {id: displayName} map, together with the
+    mailFolders/delta link it was last brought up to date with. A run only
+    replays the folder changes since then; the first run, or one whose link
+    has expired, lists the whole hierarchy. The subtree is then assembled
+    in memory instead of issuing a childFolders listing per folder.
+    """
+    # work on a copy so a retried or failed walk leaves the stored tree intact
+    children = {parent: dict(kids) for parent, kids in folder_state.get("children", {}).items()}
+    url = folder_state.get("delta_link")
+    if not url:
+        url, children = FOLDER_DELTA_URL, {}
+    parent_of = {fid: parent for parent, kids in children.items() for fid in kids}
+    delta_link = None
+    while url:
+        resp = SESSION.get(url, headers=FOLDER_DELTA_HEADERS)
+        if resp.status_code == 410 and url != FOLDER_DELTA_URL:
+            # the sync state expired; start over with a full listing
+            logger.info("[Graph] Folder delta link expired; re-listing folders")
+            url, children, parent_of = FOLDER_DELTA_URL, {}, {}
+            continue
+        resp.raise_for_status()
+        page = orjson.loads(resp.content)
+        for folder in page.get("value", []):
+            fid = folder["id"]
+            # a renamed or moved folder comes back whole; drop its old entry
+            old_parent = parent_of.pop(fid, None)
+            if old_parent is not None:
+                children.get(old_parent, {}).pop(fid, None)
+            if "@removed" in folder or not folder.get("parentFolderId"):
+                continue
+            children.setdefault(folder["parentFolderId"], {})[fid] = folder.get("displayName")
+            parent_of[fid] = folder["parentFolderId"]
+        url = page.get("@odata.nextLink")
+        delta_link = page.get("@odata.deltaLink") or delta_link
+
+    folder_state["children"] = children
+    folder_state["delta_link"] = delta_link
+
+    folder_paths = {base_fid: base_path}
+    level = [base_fid]
+    while level:
+        next_level = []
+        for fid in level:
+            for child_id, name in children.get(fid, {}).items():
+                folder_paths[child_id] = folder_paths[fid] + [name]
+                next_level.append(child_id)
+        level = next_level
+    return folder_paths
+
+
+def message_delta_url(fid, since=None):
+    """Relative URL of a fresh messages/delta query for folder ``fid``.
+
+    Only IDs are listed; full payloads are fetched for new messages alone.
+    A folder synced before delta links existed passes its old watermark as
+    ``since`` (`ge`, so same-second ties are settled by the processed IDs).
+    """
+    params = {"$select": "id,receivedDateTime"}
+    if since:
+        params["$filter"] = f"receivedDateTime ge {since}"
+    return (
+        f"/users/{MAIL_USER}/mailFolders/{fid}/messages/delta?"
+        + urlencode(params, quote_via=quote, safe="$,")
     )
-    result = app.acquire_token_for_client(scopes=SCOPES)
-    if "access_token" not in result:
-        raise Exception(f"Token error: {result.get('error_description')}")
-    logger.info("[Graph] Acquired access token")
-    return result["access_token"]
 
 
-def load_processed_ids(path):
-    if not os.path.exists(path):
-        return set()
-    with open(path, "r", encoding="utf-8") as f:
-        return set(line.strip() for line in f if line.strip())
+def iter_message_pages(first_urls, fetcher, restart=None):
+    """Yield ``(folder_id, page)`` for every message delta page of every folder.
 
+    ``first_urls`` maps folder ids to the relative URL of their first delta
+    page (a fresh ``messages/delta`` query or a stored delta link).
+    Up to GRAPH_BATCH_LIMIT listings go out per $batch call; a folder's
+    @odata.nextLink joins the following call, so each folder's pages arrive
+    in order. The next call runs on ``fetcher`` while the caller works on
+    the current pages. A folder whose listing is rejected with 404/410 is
+    requeued once with the URL ``restart(fid)`` returns, if any; other failed
+    listings, or a failed $batch call, are logged and their folders dropped.
+    """
+    queue = list(first_urls.items())
+    restarted = set()
 
-def save_processed_id(path, msg_id):
+    def fetch(items):
+        batch = [
+            # delta queries page via Prefer rather than $top
+            {"id": str(i), "method": "GET", "url": url, "headers": {"Prefer": "odata.maxpagesize=50"}}
+            for i, (_, url) in enumerate(items)
+        ]
+        return items, graph_batch(batch)
+
+    pending_items = queue[:GRAPH_BATCH_LIMIT]
+    pending = fetcher.submit(fetch, pending_items) if queue else None
+    queue = queue[GRAPH_BATCH_LIMIT:]
+    while pending:
+        try:
+            items, responses = pending.result()
+        except Exception:
+            # the whole call failed; drop its folders, keep the rest going
+            logger.exception("Listing batch failed for folders %s", [fid for fid, _ in pending_items])
+            items, responses = [], {}
+        pages, continuations = [], []
+        for i, (fid, _) in enumerate(items):
+            sub = responses.get(str(i), {})
+            status = sub.get("status", 500)
+            if status in (404, 410) and restart and fid not in restarted:
+                restarted.add(fid)
+                url = restart(fid)
+                if url:
+                    logger.warning("Delta link for folder %s rejected (%s); relisting", fid, status)
+                    continuations.append((fid, url))
+                    continue
+            if status >= 400:
+                logger.error("Request failed for folder %s: %s %s", fid, status, sub.get("body"))
+                continue
+            page = sub.get("body", {})
+            if page.get("@odata.nextLink"):
+                continuations.append((fid, _relative(page["@odata.nextLink"])))
+            pages.append((fid, page))
+        # finish folders already in progress before starting new ones
+        queue = continuations + queue
+        pending_items = queue[:GRAPH_BATCH_LIMIT]
+        pending = fetcher.submit(fetch, pending_items) if queue else None
+        queue = queue[GRAPH_BATCH_LIMIT:]
+        yield from pages
+
+
+def open_processed_db(path, legacy_path=PROCESSED_IDS_FILE):
+    """Open the processed-ID store, importing the legacy text log once."""
     os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
-    with open(path, "a", encoding="utf-8") as f:
-        f.write(msg_id + "\n")
+    conn = sqlite3.connect(path)
+    # WAL + NORMAL: commits append to the log without an fsync each time
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("CREATE TABLE IF NOT EXISTS done(id TEXT PRIMARY KEY)")
+    if os.path.exists(legacy_path):
+        # one bulk read; IDs carry no whitespace besides the line breaks
+        with open(legacy_path, "r", encoding="utf-8") as f:
+            legacy_ids = {mid for mid in f.read().splitlines() if mid}
+        save_processed_ids(conn, legacy_ids)
+        os.replace(legacy_path, legacy_path + ".migrated")
+        logger.info("Imported %d processed IDs from %s", len(legacy_ids), legacy_path)
+    return conn
+
+
+class MmapBloom:
+    """Fixed-size Bloom filter kept in a memory-mapped file.
+
+    Sized from ``capacity``/``error_rate`` as m = -n ln p / (ln 2)^2 bits with
+    k = m/n ln 2 probes. The k positions come from one BLAKE2b-128 digest
+    split into two 64-bit halves (Kirsch-Mitzenmacher double hashing). The
+    header stores k and the number of keys added, so a stale file can be
+    spotted and rebuilt.
+    """
+
+    _HEADER = struct.Struct("<4sIQ")  # magic, k, count
+    _MAGIC = b"BLM1"
+
+    def __init__(self, path, capacity, error_rate):
+        m = int(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        self.nbytes = (m + 7) // 8
+        self.m = self.nbytes * 8
+        k = max(1, round(self.m / capacity * math.log(2)))
+        size = self._HEADER.size + self.nbytes
+        fresh = not os.path.exists(path) or os.path.getsize(path) != size
+        self._file = open(path, "w+b" if fresh else "r+b")
+        if fresh:
+            self._file.truncate(size)
+        self._mm = mmap.mmap(self._file.fileno(), size)
+        magic, self.k, self.count = self._HEADER.unpack_from(self._mm)
+        if fresh or magic != self._MAGIC or self.k != k:
+            self.clear(k)
+
+    def _positions(self, key):
+        h1, h2 = struct.unpack("<QQ", hashlib.blake2b(key.encode(), digest_size=16).digest())
+        return [(h1 + i * h2) % self.m for i in range(self.k)]
+
+    def __contains__(self, key):
+        mm, base = self._mm, self._HEADER.size
+        return all(mm[base + (p >> 3)] & (1 << (p & 7)) for p in self._positions(key))
+
+    def add(self, key):
+        mm, base = self._mm, self._HEADER.size
+        new = False
+        for p in self._positions(key):
+            i, bit = base + (p >> 3), 1 << (p & 7)
+            if not mm[i] & bit:
+                mm[i] |= bit
+                new = True
+        if new:
+            self.count += 1
+        return new
+
+    def clear(self, k=None):
+        self.k = k or self.k
+        self.count = 0
+        self._mm[self._HEADER.size:] = bytes(self.nbytes)
+
+    def flush(self):
+        self._HEADER.pack_into(self._mm, 0, self._MAGIC, self.k, self.count)
+        self._mm.flush()
+
+    def close(self):
+        self.flush()
+        self._mm.close()
+        self._file.close()
+
+
+class ProcessedIndex:
+    """Bloom filter in front of the ``done`` table.
 
+    A Bloom miss means the ID is definitely new; only a hit costs an indexed
+    SQLite lookup, so the full ID set never has to sit in memory. The table
+    stays the ground truth: when the filter's key count disagrees with it
+    (first run, a crash between commit and flush) the filter is rebuilt.
+    """
 
-def ensure_temp_dir(path):
-    os.makedirs(path, exist_ok=True)
+    def __init__(self, conn, bloom):
+        self.conn = conn
+        self.bloom = bloom
+        (rows,) = conn.execute("SELECT COUNT(*) FROM done").fetchone()
+        if bloom.count != rows:
+            logger.info("Rebuilding processed-ID Bloom filter (%d != %d IDs)", bloom.count, rows)
+            bloom.clear()
+            for (mid,) in conn.execute("SELECT id FROM done"):
+                bloom.add(mid)
+            bloom.flush()
 
+    def __contains__(self, mid):
+        if mid not in self.bloom:
+            return False
+        row = self.conn.execute("SELECT 1 FROM done WHERE id = ?", (mid,)).fetchone()
+        return row is not None
 
+    def update(self, msg_ids):
+        for mid in msg_ids:
+            self.bloom.add(mid)
+        self.bloom.flush()
+
+
+def load_processed_ids(conn, bloom_path=PROCESSED_BLOOM_FILE):
+    """Return a Bloom-filtered membership index over processed IDs."""
+    bloom = MmapBloom(bloom_path, BLOOM_CAPACITY, BLOOM_ERROR_RATE)
+    atexit.register(bloom.close)
+    return ProcessedIndex(conn, bloom)
+
+
+def save_processed_ids(conn, msg_ids):
+    """Record a batch of processed message IDs in a single transaction."""
+    with conn:
+        conn.executemany(
+            "INSERT OR IGNORE INTO done(id) VALUES (?)",
+            ((mid,) for mid in msg_ids),
+        )
+
+
+def load_sync_state(path):
+    if not os.path.exists(path):
+        return {"delta_links": {}}
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_json(path, data):
+    """Write ``data`` as JSON via a temp file so readers never see a torn file."""
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(data, f)
+    os.replace(tmp, path)
+
+
+@functools.lru_cache(maxsize=1)
 def connect_asana(pat):
+    """Build the Asana API clients once per PAT, sharing one pooled ApiClient."""
     config = asana.Configuration()
     config.access_token = pat
+    # at least one pooled connection per worker and upload slot; the SDK's
+    # own default (cpu_count() * 5) is kept when it is already larger
+    config.connection_pool_maxsize = max(
+        config.connection_pool_maxsize, MAX_WORKERS + ASANA_UPLOAD_SLOTS
+    )
+    # Transport-level retries for connection errors and 5xx on idempotent
+    # methods; 429s are left to throttle_retry, which honours Retry-After.
+    config.retry_strategy = Retry(
+        total=5,
+        backoff_factor=1.0,
+        status_forcelist=(500, 502, 503, 504),
+        raise_on_status=False,
+    )
     client = asana.ApiClient(config)
     tasks_api = asana.TasksApi(client)
     attach_api = asana.AttachmentsApi(client)
     sections_api = asana.SectionsApi(client)
-    user = asana.UsersApi(client).get_user("me", {})
-    logger.info("[Asana] Connected as %s (%s)", user['name'], user['email'])
+    if ASANA_VERIFY:
+        user = asana.UsersApi(client).get_user("me", {})
+        logger.info("[Asana] Connected as %s (%s)", user['name'], user['email'])
     return tasks_api, attach_api, sections_api
 
 
-def get_target_folder_id(token, path_list):
-    headers = {"Authorization": f"Bearer {token}"}
+def _revalidate_folder(entry, name):
+    """Return the cached folder id if it still names ``name``, else None.
+
+    Sends the stored ETag as If-None-Match so an unchanged folder costs a
+    bodyless 304; on a 200 the id is kept as long as the name still matches.
+    """
+    headers = {"If-None-Match": entry["etag"]} if entry.get("etag") else {}
+    resp = SESSION.get(
+        f"{GRAPH_BASE}/users/{MAIL_USER}/mailFolders/{entry['id']}",
+        params={"$select": "id,displayName"},
+        headers=headers,
+    )
+    if resp.status_code == 304:
+        return entry["id"]
+    if not resp.ok:
+        return None
+    folder = orjson.loads(resp.content)
+    if folder.get("displayName") != name:
+        return None
+    entry["etag"] = folder.get("@odata.etag") or resp.headers.get("ETag")
+    return entry["id"]
+
+
+@graph_retry
+def get_target_folder_id(path_list):
+    key = f"{MAIL_USER}/" + "/".join(path_list)
+    cache = {}
+    if os.path.exists(FOLDER_CACHE_FILE):
+        with open(FOLDER_CACHE_FILE, "r", encoding="utf-8") as f:
+            cache = json.load(f)
+    entry = cache.get(key)
+    if entry and _revalidate_folder(entry, path_list[-1]):
+        save_json(FOLDER_CACHE_FILE, cache)
+        logger.info("[Graph] Folder ID '%s' for path %s (cached)", entry["id"], '/'.join(path_list))
+        return entry["id"]
+
     folder_id = None
     for part in path_list:
         url = (
             f"{GRAPH_BASE}/users/{MAIL_USER}/mailFolders/{folder_id}/childFolders"
             if folder_id else f"{GRAPH_BASE}/users/{MAIL_USER}/mailFolders"
         )
-        resp = requests.get(url, headers=headers)
+        # ask for the one child by name rather than paging through siblings
+        name = part.replace("'", "''")
+        resp = SESSION.get(url, params={
+            "$filter": f"displayName eq '{name}'",
+            "$select": "id,displayName",
+        })
         resp.raise_for_status()
-        items = resp.json().get("value", [])
+        items = orjson.loads(resp.content).get("value", [])
         match = next((i for i in items if i.get("displayName") == part), None)
         if not match:
             raise Exception(f"Folder '{part}' not found at {url}")
         folder_id = match.get("id")
+        etag = match.get("@odata.etag")
     logger.info("[Graph] Folder ID '%s' for path %s", folder_id, '/'.join(path_list))
+    cache[key] = {"id": folder_id, "etag": etag}
+    save_json(FOLDER_CACHE_FILE, cache)
     return folder_id
 
 
-def process_message(msg, tasks_api, attach_api, sections_api, location, job_num, token):
+def build_task_payload(msg, notes_prefix, location, job_number):
+    """Turn a Graph message into an Asana task payload (no I/O)."""
     subj = msg.get("subject", "(No Subject)")
     received = msg.get("receivedDateTime", "")
-    sender = (
-        msg.get("from", {}).get("emailAddress", {})
-           .get("address", "")
-    )
+    try:
+        sender = msg["from"]["emailAddress"]["address"]
+    except (KeyError, TypeError):
+        sender = ""
 
     # --- DEBUG: inspect the raw body node ---
     body_node = msg.get("body")
     logger.debug("Body node for message %s: %r", msg.get("id"), body_node)
-    if isinstance(body_node, dict):
-        if "content" not in body_node:
-            logger.error(
-                "Message %s: 'body' missing 'content' key. Available keys: %r",
-                msg.get("id"),
-                list(body_node.keys()),
-            )
-        body = body_node.get("content", "")
-    else:
+    try:
+        body = body_node["content"]
+    except KeyError:
+        logger.error(
+            "Message %s: 'body' missing 'content' key. Available keys: %r",
+            msg.get("id"),
+            list(body_node.keys()),
+        )
+        body = ""
+    except TypeError:
+        # body absent or not an object
         preview = msg.get("bodyPreview")
         logger.debug(
             "Using bodyPreview for message %s: %r", msg.get("id"), preview
@@ -162,110 +781,199 @@ def process_message(msg, tasks_api, attach_api, sections_api, location, job_num,
         body = preview or ""
 
     # Sanitize HTML bodies to plain text
-    if body.lstrip().startswith("<"):
-        soup = BeautifulSoup(body, "html.parser")
-        clean_body = soup.get_text(separator="\n").strip()
+    if _HTML_PREFIX_RE.match(body):
+        text = _TAG_RE.sub("\n", _SCRIPT_STYLE_RE.sub("", body))
+        clean_body = html.unescape(text).strip()
     else:
         clean_body = body.strip()
 
-    notes = (
-        f"**Location:** {location}\n"
-        f"**Job #:** {job_num}\n"
-        f"**From:** {sender}\n"
-        f"**Received:** {received}\n\n"
-        f"{clean_body}"
-    )
+    notes = f"{notes_prefix}**From:** {sender}\n**Received:** {received}\n\n{clean_body}"
 
     subject_lower = subj.lower()
-    if "budget" in subject_lower and BUDGET_SECTION_GID:
-        section_gid = BUDGET_SECTION_GID
-    elif "quotation" in subject_lower and QUOTE_SECTION_GID:
-        section_gid = QUOTE_SECTION_GID
-    elif "order confirmation" in subject_lower and ORDER_SECTION_GID:
-        section_gid = ORDER_SECTION_GID
-    else:
-        section_gid = ASANA_SECTION_GID
+    section_gid = next((gid for token, gid in ROUTES if token in subject_lower), ASANA_SECTION_GID)
+
+    # only fields whose GID is configured; a None key would be sent as "null"
+    custom_fields = {}
+    if LOCATION_FIELD_GID:
+        custom_fields[LOCATION_FIELD_GID] = location
+    if JOB_NUMBER_FIELD_GID and job_number is not None:
+        custom_fields[JOB_NUMBER_FIELD_GID] = job_number
 
-    task_payload = {
+    # Create the task already placed in its section and with its custom
+    # fields set, so one request replaces create + addTask + update.
+    return {
         "name": subj,
         "notes": notes,
-        "projects": [ASANA_PROJECT_GID],
+        "memberships": [{"project": ASANA_PROJECT_GID, "section": section_gid}],
+        "custom_fields": custom_fields,
         "workspace": ASANA_WORKSPACE_GID,
     }
-    task = tasks_api.create_task({"data": task_payload}, {})
-    gid = task.get("gid")
 
-    # Add the task to the chosen section
+
+def create_task_with_fields(tasks_api, payload):
+    """Create the task in one call, falling back to update_task on a 400.
+
+    A custom field value Asana rejects (e.g. a job number with no matching
+    enum option) fails the whole create; retry without the fields and set
+    them separately so the task itself is not lost.
+    """
     try:
-        sections_api.add_task_for_section(
-            section_gid,
-            {
-                "body": {
-                    "data": {
-                        "task": gid
-                    }
-                }
-            }
-        )
-    except Exception as e:
-        logger.error(
-            "Failed to add task %s to section %s: %s",
-            gid,
-            section_gid,
-            e,
-        )
+        return create_task(tasks_api, payload)
+    except asana.rest.ApiException as exc:
+        if exc.status != 400 or not payload.get("custom_fields"):
+            raise
+        fields = payload.pop("custom_fields")
+        logger.warning("[Asana] Task create rejected custom fields (%s); retrying without", exc.reason)
+    task = create_task(tasks_api, payload)
+    try:
+        update_task(tasks_api, task["gid"], {"custom_fields": fields})
+    except asana.rest.ApiException as exc:
+        logger.error("[Asana] Could not set custom fields on task %s: %s", task["gid"], exc.reason)
+    return task
+
+
+def process_message(msg, parent_id, tasks_api, attach_api, notes_prefix, location, job_number):
+    payload = build_task_payload(msg, notes_prefix, location, job_number)
+    task = create_task_with_fields(tasks_api, payload)
+    # hasAttachments is false when every attachment is inline, so go by the
+    # expanded list itself
+    if msg.get("attachments"):
+        copy_attachments(msg, parent_id, attach_api, task.get("gid"))
 
-    # update custom fields on the created task (wrap under 'body')
-    update_payload = {
-        LOCATION_FIELD_GID: location,
-        JOB_NUMBER_FIELD_GID: int(job_num)
-    }
-    tasks_api.update_task(
-        {"data": update_payload},
-        gid,
-        {}
-    )
 
-    # handle attachments
-    ensure_temp_dir(TEMP_DIR)
-    headers = {"Authorization": f"Bearer {token}"}
-    parent_id = msg.get("parentFolderId")
+def copy_attachments(msg, parent_id, attach_api, gid):
+    """Copy a message's file attachments from Graph onto Asana task ``gid``.
+
+    The metadata arrived with the message itself (see fetch_messages); small
+    payloads are fetched in one Graph batch and larger ones streamed. The
+    uploads and streamed transfers run on the shared attachment pool.
+    """
+    batched, streamed = {}, []
     for att in msg.get("attachments", []):
-        if att.get("@odata.type", "").endswith("ItemAttachment"):
+        # only file attachments have a downloadable $value; item and
+        # reference attachments are skipped before any size or network work
+        if att.get("@odata.type") != "#microsoft.graph.fileAttachment":
             continue
-        if att.get("size", 0) > 3 * 1024 * 1024:
+        if att.get("size", 0) > MAX_ATTACHMENT_SIZE:
             logger.warning("[SKIP] Attachment too large: %s", att.get("name"))
             continue
-        att_id = att.get("id")
-        url = (
-            f"{GRAPH_BASE}/users/{MAIL_USER}/mailFolders/"
+        if att.get("size", 0) > BATCH_ATTACHMENT_SIZE:
+            streamed.append(att)
+        else:
+            batched[str(len(batched))] = att
+
+    def value_path(att):
+        return (
+            f"/users/{MAIL_USER}/mailFolders/"
             f"{parent_id}/messages/{msg['id']}/"
-            f"attachments/{att_id}/$value"
+            f"attachments/{att.get('id')}/$value"
         )
-        try:
-            r = requests.get(url, headers=headers)
-            r.raise_for_status()
-        except HTTPError:
-            if r.status_code == 413:
-                logger.warning("[SKIP] Attachment too large: %s", att.get('name'))
-                continue
-            else:
-                raise
-        local = os.path.join(TEMP_DIR, att.get("name"))
-        with open(local, "wb") as f:
-            f.write(r.content)
-        try:
-            with open(local, "rb") as fp:
-                # skip attachment upload if API signature changes
-                attach_api.create_attachment_for_object("tasks", gid, {"file": fp})
-        except Exception as e:
-            logger.warning(f"Skipping attachment upload for task {gid}: {e}")
-        os.remove(local)
+
+    batch = [
+        {"id": req_id, "method": "GET", "url": value_path(att)}
+        for req_id, att in batched.items()
+    ]
+    futures = []
+    for req_id, sub in (graph_batch(batch).items() if batch else ()):
+        att = batched[req_id]
+        status = sub.get("status", 500)
+        if status == 413:
+            logger.warning("[SKIP] Attachment too large: %s", att.get('name'))
+            continue
+        if status >= 400:
+            raise Exception(
+                f"Attachment download failed ({status}) for {att.get('name')}: {sub.get('body')}"
+            )
+        # binary sub-response bodies come back base64-encoded; upload them
+        # straight from memory rather than through a temp file
+        buf = io.BytesIO(base64.b64decode(sub.get("body", "")))
+        futures.append(_attachment_pool.submit(upload_attachment, attach_api, gid, att.get("name"), buf))
+
+    futures += [
+        _attachment_pool.submit(stream_attachment, attach_api, gid, att.get("name"),
+                                f"{GRAPH_BASE}{value_path(att)}")
+        for att in streamed
+    ]
+    for future in as_completed(futures):
+        future.result()
+
+
+def stream_attachment(attach_api, gid, name, url):
+    """Download one large attachment and upload it to task ``gid``."""
+    try:
+        buf = download_attachment(url)
+    except HTTPError as err:
+        if err.response is not None and err.response.status_code == 413:
+            buf = None
+        else:
+            raise
+    if buf is None:
+        logger.warning("[SKIP] Attachment too large: %s", name)
+        return
+    upload_attachment(attach_api, gid, name, buf)
+
+
+@graph_retry
+def download_attachment(url):
+    """Stream one attachment's $value into an in-memory buffer.
+
+    The response headers arrive before the body, so an oversized payload is
+    refused from its Content-Length without reading it; otherwise the body
+    is copied in 256 KiB chunks. Holds a mailbox slot until the body is read.
+    Returns None when the size limit is hit.
+    """
+    with _mailbox_slots, SESSION.get(url, stream=True) as r:
+        r.raise_for_status()
+        if int(r.headers.get("Content-Length") or 0) > MAX_ATTACHMENT_SIZE:
+            return None
+        buf = io.BytesIO()
+        for chunk in r.iter_content(chunk_size=256 * 1024):
+            buf.write(chunk)
+            if buf.tell() > MAX_ATTACHMENT_SIZE:
+                return None
+    buf.seek(0)
+    return buf
+
+
+@throttle_retry
+def create_task(tasks_api, payload):
+    ASANA_LIMITER.acquire()
+    return tasks_api.create_task({"data": payload}, {})
+
+
+@throttle_retry
+def update_task(tasks_api, gid, payload):
+    ASANA_LIMITER.acquire()
+    return tasks_api.update_task({"data": payload}, gid, {})
+
+
+@throttle_retry
+def _create_attachment(attach_api, gid, buf):
+    buf.seek(0)  # rewind for retries
+    ASANA_LIMITER.acquire()
+    attach_api.create_attachment_for_object("tasks", gid, {"file": buf})
+
+
+def upload_attachment(attach_api, gid, name, buf):
+    buf.name = name
+    try:
+        # skip attachment upload if API signature changes
+        with _upload_slots:
+            _create_attachment(attach_api, gid, buf)
+    except Exception as e:
+        logger.warning(f"Skipping attachment upload for task {gid}: {e}")
 
 
 def main():
-    token = get_access_token()
-    done = load_processed_ids(PROCESSED_IDS_FILE)
+    get_access_token()
+    db = open_processed_db(PROCESSED_DB_FILE)
+    # close (and checkpoint the WAL) however the run ends
+    atexit.register(db.close)
+    done = load_processed_ids(db)
+    state = load_sync_state(SYNC_STATE_FILE)
+    delta_links = state.setdefault("delta_links", {})
+    # receivedDateTime marks from before delta sync; only seed first deltas
+    watermarks = state.get("last_received", {})
     tasks_api, attach_api, sections_api = connect_asana(ASANA_PAT)
 
     # diagnostics: dump all sections for this project
@@ -281,78 +989,104 @@ def main():
     # ─── FULL RUN: iterate every subfolder of Inbox/2024 Jobs ───
     # 1) Find the base folder ID for ["Inbox", "2024 Jobs"]
     base_path = MAIL_FOLDER_PATH[:2]
-    base_fid  = get_target_folder_id(token, base_path)
+    base_fid  = get_target_folder_id(base_path)
 
-    # 2) Recursively collect all folder IDs under that base
-    def collect_folder_ids(folder_id):
-        ids = [folder_id]
-        child_url = f"{GRAPH_BASE}/users/{MAIL_USER}/mailFolders/{folder_id}/childFolders"
-        r = requests.get(child_url, headers={"Authorization": f"Bearer {token}"})
-        r.raise_for_status()
-        for child in r.json().get("value", []):
-            ids.extend(collect_folder_ids(child["id"]))
-        return ids
-
-    folder_ids = collect_folder_ids(base_fid)
-
-    # 3) Map each folder ID back to its displayName path so we can extract loc/job
-    folder_paths = {}
-    def map_paths(path_so_far, folder_id):
-        folder_paths[folder_id] = path_so_far
-        url = f"{GRAPH_BASE}/users/{MAIL_USER}/mailFolders/{folder_id}/childFolders"
-        resp = requests.get(url, headers={"Authorization": f"Bearer {token}"})
-        resp.raise_for_status()
-        for child in resp.json().get("value", []):
-            map_paths(path_so_far + [child["displayName"]], child["id"])
-
-    map_paths(base_path, base_fid)
+    # 2) Map every folder under that base to its displayName path so we can
+    #    extract loc/job
+    folder_paths = walk_folders(base_fid, base_path, state.setdefault("folders", {}))
+    save_json(SYNC_STATE_FILE, state)
 
-    # 4) Loop through each folder, paging through messages exactly as before
-    for fid in folder_ids:
-        path = folder_paths.get(fid, [])
+    # 3) Work out each folder's fixed task fields and first listing URL
+    folders, first_urls = {}, {}
+    for fid, path in folder_paths.items():
         # derive location/job if path depth >= 4: ["Inbox","2024 Jobs", LOC, JOB#]
         if len(path) >= 4:
             loc, job = path[-2], path[-1]
         else:
             loc = job = ""
-
-        headers = {"Authorization": f"Bearer {token}"}
-        params  = {
-            "$select" : "id,subject,body,receivedDateTime,from,parentFolderId",
-            "$expand" : "attachments",
-            "$top"    : 50,
+        folders[fid] = {
+            "loc": loc,
+            # parse the job number once per folder rather than per message;
+            # folders above job level carry none
+            "job_number": int(job) if job.isdigit() else None,
+            # the notes header is the same for every message in the folder
+            "notes_prefix": f"**Location:** {loc}\n**Job #:** {job}\n",
+            # a folder with a failed message keeps its old delta link so
+            # the next run replays it
+            "failed": False,
         }
-        next_url = f"{GRAPH_BASE}/users/{MAIL_USER}/mailFolders/{fid}/messages"
 
-        while next_url:
-            resp = requests.get(next_url, headers=headers, params=params if next_url.endswith("/messages") else None)
+        if delta_links.get(fid):
+            # resume exactly where the last complete sync of this folder ended
+            first_urls[fid] = _relative(delta_links[fid])
+        else:
+            first_urls[fid] = message_delta_url(fid, watermarks.get(fid))
+
+    def restart_delta(fid):
+        # a stored link Graph no longer honours (expired sync state, deleted
+        # folder) is dropped and the folder listed afresh
+        if delta_links.pop(fid, None) is None:
+            return None
+        save_json(SYNC_STATE_FILE, state)
+        return message_delta_url(fid, watermarks.get(fid))
+
+    # 4) Page through every folder's messages, batching the listings; the
+    #    messages of each page are processed concurrently while a single
+    #    fetcher thread already downloads the next batch of pages
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as pool, \
+            ThreadPoolExecutor(max_workers=1) as fetcher:
+        for fid, data in iter_message_pages(first_urls, fetcher, restart_delta):
+            folder = folders[fid]
+            # deletions show up in a delta as @removed stubs
+            msgs = [m for m in data.get("value", []) if "@removed" not in m]
+            new = [m for m in msgs if m["id"] not in done]
             try:
-                resp.raise_for_status()
-            except HTTPError as err:
-                logger.error("Request failed for folder %s: %s", fid, err)
-                break
-
-            data = resp.json()
-            for msg in data.get("value", []):
-                if 'body' not in msg:
-                    continue
-                mid = msg["id"]
-                if mid in done:
-                    continue
+                full = fetch_messages([m["id"] for m in new]) if new else {}
+            except Exception:
+                # keep the folder's old delta link so the next run replays it
+                logger.exception("Fetching messages failed for folder %s", fid)
+                folder["failed"] = True
+                continue
+            futures = {
+                pool.submit(
+                    process_message, full[m["id"]], fid, tasks_api, attach_api,
+                    folder["notes_prefix"], folder["loc"], folder["job_number"],
+                ): m
+                for m in new
+                if 'body' in full.get(m["id"], {})
+            }
+            finished = []
+            if any(m["id"] not in full for m in new):
+                folder["failed"] = True
+            for future in as_completed(futures):
+                msg = futures[future]
                 try:
-                    process_message(msg, tasks_api, attach_api, sections_api, loc, job, token)
-                    save_processed_id(PROCESSED_IDS_FILE, mid)
+                    future.result()
+                    finished.append(msg["id"])
                 except Exception:
-                    logger.exception("Error processing message %s", mid)
-                time.sleep(SLEEP_INTERVAL)
+                    logger.exception("Error processing message %s", msg["id"])
+                    folder["failed"] = True
+            save_processed_ids(db, finished)
+            done.update(finished)
 
-            next_url = data.get("@odata.nextLink")
+            # the last page of a folder's delta carries the link for next run
+            if data.get("@odata.deltaLink") and not folder["failed"]:
+                delta_links[fid] = data["@odata.deltaLink"]
+                watermarks.pop(fid, None)
+                save_json(SYNC_STATE_FILE, state)
 
     logger.info("\u2705 Full run complete over all subfolders of 2024 Jobs.")
 
 
 def _matrix_effect(stop_event):
-    """Print a vertical stream of binary digits (Matrix rain) until stopped."""
+    """Print a vertical stream of binary digits (Matrix rain) until stopped.
+
+    Does nothing unless stdout is a terminal. Each frame is one os.write of
+    a reused line buffer, bypassing print() and the sys.stdout wrapper that
+    the run captures.
+    """
+    if not sys.__stdout__.isatty():
+        return
     try:
         # get terminal width if available
         import shutil
@@ -360,12 +1094,14 @@ def _matrix_effect(stop_event):
     except Exception:
         width = 80
 
+    fd = sys.__stdout__.fileno()
+    line = bytearray(b" " * width + b"\n")
     while not stop_event.is_set():
-        # build an empty line and drop a bit at a random column
-        line = [" " for _ in range(width)]
+        # drop a bit at a random column of the blank line, then blank it again
         col = random.randrange(width)
-        line[col] = random.choice("01")
-        print("".join(line))
+        line[col] = random.choice(b"01")
+        os.write(fd, line)
+        line[col] = 0x20
         time.sleep(0.05)
 
     # clear the screen at the end
@@ -375,31 +1111,54 @@ def _matrix_effect(stop_event):
         os.system("clear")
 
 
+def _to_binary(data):
+    """Render ``data`` bytes as space-separated 8-bit groups."""
+    bits = np.unpackbits(np.frombuffer(data, dtype=np.uint8))
+    # one row per byte: eight ASCII digits followed by a space
+    rows = np.full((bits.size // 8, 9), ord(" "), dtype=np.uint8)
+    rows[:, :8] = bits.reshape(-1, 8) + ord("0")
+    return rows.tobytes()[:-1].decode("ascii")
+
+
+DUMP_CHUNK = 64 * 1024
+
+
 if __name__ == "__main__":
     # initialize colorama for ANSI support in Powershell
     _colorama_init()
 
-    # Capture all stdout/stderr during run
+    # Capture all stdout/stderr during run into RUN_LOG_FILE rather than
+    # memory, so a long run's output never has to be held whole
     old_out, old_err = sys.stdout, sys.stderr
-    buffer = io.StringIO()
-    sys.stdout = buffer
-    sys.stderr = buffer
+    capture = open(RUN_LOG_FILE, "w+", encoding="utf-8")
+    sys.stdout = capture
+    sys.stderr = capture
     try:
         main()
     except Exception:
-        buffer.write(traceback.format_exc())
+        capture.write(traceback.format_exc())
     finally:
         # restore real stdout/stderr
         sys.stdout, sys.stderr = old_out, old_err
+        capture.close()
 
-    # Grab the text that was generated
-    output = buffer.getvalue()
-
-    # Convert each character to 8-bit binary
-    binary = " ".join(format(ord(ch), "08b") for ch in output)
+    with open(RUN_LOG_FILE, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        output = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
 
-    # Print the binary dump in green
-    print(Fore.GREEN + binary)
+        # Print the binary dump in green, converting a chunk at a time
+        sys.stdout.write(Fore.GREEN)
+        for start in range(0, size, DUMP_CHUNK):
+            if start:
+                sys.stdout.write(" ")
+            sys.stdout.write(_to_binary(output[start:start + DUMP_CHUNK]))
+        sys.stdout.write("\n")
+        sys.stdout.flush()
 
-    # Then print the original output (traceback or success)
-    print(output)
+        # Then print the original output (traceback or success)
+        for start in range(0, size, DUMP_CHUNK):
+            sys.stdout.buffer.write(output[start:start + DUMP_CHUNK])
+        sys.stdout.buffer.write(b"\n")
+        sys.stdout.flush()
+        if size:
+            output.close()
@@ -21,6 +21,7 @@ import asyncio
 import os
 import json
 import re
+import orjson
 from dotenv import load_dotenv
 
 import structlog
@@ -32,6 +33,8 @@ from datetime import datetime
 from typing import List, Optional
 from transformers import AutoTokenizer, AutoModel
 import numpy as np
+import torch
+from sklearn.decomposition import PCA
 try:
     import hdbscan
 except ImportError:
@@ -40,10 +43,26 @@ try:
     from pymdptoolbox.mdp import ValueIteration
 except ImportError:
     ValueIteration = None
+try:
+    import onnxruntime as ort
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+except ImportError:
+    ort = None
 
 # structured logger
 logger = structlog.get_logger()
 
+GRAPH_SCOPES = ["https://graph.microsoft.com/.default"]
+COMMON_AUTHORITY = "https://login.microsoftonline.com/common"
+_UUID_RE = re.compile(r"[0-9a-fA-F-]{36}")
+TOKEN_CACHE_FILE = ".msal_cache_analytics"
+
+EMBED_BATCH = 512   # bodies tokenized and embedded per forward pass
+MAX_CHARS = 2048    # pre-truncation bound before tokenizing
+MAX_TOKENS = 256
+CLUSTER_DIMS = 32   # PCA components fed to HDBSCAN
+MIN_CLUSTER_SIZE = 5
+
 class EmailMessage(BaseModel):
     id: str
     subject: str
@@ -52,23 +71,23 @@ class EmailMessage(BaseModel):
     body: str
 
 async def async_paginate(client: AsyncClient, url: str, params: dict):
-    items = []
+    """Yield the items of a Graph collection page by page via @odata.nextLink."""
     while url:
         resp = await client.get(url, params=params)
         try:
             resp.raise_for_status()
         except HTTPError:
             try:
-                body = resp.json()
+                body = orjson.loads(resp.content)
             except ValueError:
                 body = resp.text
             logger.error("HTTP request failed", url=str(resp.url), body=body)
             raise
-        data = resp.json()
-        items.extend(data.get('value', []))
+        data = orjson.loads(resp.content)
+        for item in data.get('value', []):
+            yield item
         url = data.get('@odata.nextLink')
         params = {}
-    return items
 
 def _resolve_authority(graph_cfg: dict) -> str:
     """Derive a usable Azure AD authority URL.
@@ -83,17 +102,36 @@ def _resolve_authority(graph_cfg: dict) -> str:
         return graph_cfg['authority']
 
     tenant_id = graph_cfg.get('tenant_id')
-    if tenant_id and re.fullmatch(r"[0-9a-fA-F-]{36}", tenant_id):
+    if tenant_id and _UUID_RE.fullmatch(tenant_id):
         return f"https://login.microsoftonline.com/{tenant_id}"
 
     logger.warning("TENANT_ID missing or invalid; using 'common' authority")
-    return "https://login.microsoftonline.com/common"
+    return COMMON_AUTHORITY
+
+
+def _load_token_cache() -> msal.SerializableTokenCache:
+    cache = msal.SerializableTokenCache()
+    if os.path.exists(TOKEN_CACHE_FILE):
+        with open(TOKEN_CACHE_FILE, 'r', encoding='utf-8') as f:
+            cache.deserialize(f.read())
+    return cache
+
+
+def _save_token_cache(cache: msal.SerializableTokenCache) -> None:
+    if cache.has_state_changed:
+        fd = os.open(TOKEN_CACHE_FILE, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write(cache.serialize())
 
 
 def acquire_token(graph_cfg: dict) -> str:
-    """Obtain an OAuth access token for Microsoft Graph."""
+    """Obtain an OAuth access token for Microsoft Graph.
+
+    MSAL's cache is persisted to TOKEN_CACHE_FILE, so a still-valid token
+    (or, for delegated auth, a refresh token) is reused across runs.
+    """
     authority = _resolve_authority(graph_cfg)
-    scopes = ["https://graph.microsoft.com/.default"]
+    cache = _load_token_cache()
     auth_mode = graph_cfg.get('auth_mode', 'app')
     if auth_mode == 'app':
         if not graph_cfg.get('client_secret'):
@@ -102,21 +140,31 @@ def acquire_token(graph_cfg: dict) -> str:
             graph_cfg['client_id'],
             authority=authority,
             client_credential=graph_cfg['client_secret'],
+            token_cache=cache,
+        )
+        result = (
+            app.acquire_token_silent(GRAPH_SCOPES, account=None)
+            or app.acquire_token_for_client(scopes=GRAPH_SCOPES)
         )
-        result = app.acquire_token_for_client(scopes=scopes)
     elif auth_mode == 'delegated':
         if not (graph_cfg.get('username') and graph_cfg.get('password')):
             raise RuntimeError('username and password required for delegated auth_mode')
-        app = msal.PublicClientApplication(graph_cfg['client_id'], authority=authority)
-        result = app.acquire_token_by_username_password(
-            graph_cfg['username'],
-            graph_cfg['password'],
-            scopes=scopes,
+        app = msal.PublicClientApplication(
+            graph_cfg['client_id'], authority=authority, token_cache=cache,
         )
+        accounts = app.get_accounts(username=graph_cfg['username'])
+        result = accounts and app.acquire_token_silent(GRAPH_SCOPES, account=accounts[0])
+        if not result:
+            result = app.acquire_token_by_username_password(
+                graph_cfg['username'],
+                graph_cfg['password'],
+                scopes=GRAPH_SCOPES,
+            )
     else:
         raise RuntimeError(f"Unsupported auth_mode: {auth_mode}")
     if 'access_token' not in result:
         raise RuntimeError(f"Token acquisition failed: {result.get('error_description')}")
+    _save_token_cache(cache)
     return result['access_token']
 
 @retry(stop=stop_after_attempt(3), wait=wait_exponential(min=2, max=10))
@@ -130,17 +178,68 @@ async def fetch_inbox(config: dict, user_id: Optional[str] = None) -> List[Email
             endpoint = f"/users/{user_id}/mailFolders/Inbox/messages"
         else:
             endpoint = "/me/mailFolders/Inbox/messages"
-        raw = await async_paginate(client, endpoint, {'$top':50})
-    return [
-        EmailMessage(
-            id=m['id'],
-            subject=m.get('subject',''),
-            sender=m['from']['emailAddress']['address'],
-            received=datetime.fromisoformat(m['receivedDateTime']),
-            body=m.get('bodyPreview','')
+        emails = []
+        async for m in async_paginate(client, endpoint, {'$top':50}):
+            emails.append(EmailMessage(
+                id=m['id'],
+                subject=m.get('subject',''),
+                sender=m['from']['emailAddress']['address'],
+                received=m['receivedDateTime'],  # pydantic parses ISO 8601, 'Z' included
+                body=m.get('bodyPreview','')
+            ))
+    return emails
+
+def onnx_session(mdl, sample: dict, path: str):
+    """Return an INT8 ONNX Runtime session for ``mdl``, exporting it once.
+
+    The FP32 export at ``path`` is dynamically quantized to ``*.int8.onnx``;
+    both files are reused on later runs.
+    """
+    int8_path = path.replace('.onnx', '.int8.onnx')
+    if not os.path.exists(int8_path):
+        axes = {0: 'batch', 1: 'seq'}
+        torch.onnx.export(
+            mdl,
+            (torch.from_numpy(sample['input_ids']), torch.from_numpy(sample['attention_mask'])),
+            path,
+            input_names=['input_ids', 'attention_mask'],
+            output_names=['last_hidden_state'],
+            dynamic_axes={'input_ids': axes, 'attention_mask': axes, 'last_hidden_state': axes},
+            opset_version=17,
         )
-        for m in raw
-    ]
+        quantize_dynamic(path, int8_path, weight_type=QuantType.QInt8)
+        logger.info("Exported quantized ONNX model", path=int8_path)
+    opts = ort.SessionOptions()
+    opts.intra_op_num_threads = os.cpu_count()
+    opts.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    return ort.InferenceSession(int8_path, opts, providers=["CPUExecutionProvider"])
+
+def embed_texts(tok, mdl, texts: List[str], session=None) -> np.ndarray:
+    """Masked-mean embeddings for ``texts``, one forward pass per EMBED_BATCH.
+
+    Runs through the ONNX Runtime ``session`` when given, else ``mdl``.
+    """
+    chunks = []
+    for start in range(0, len(texts), EMBED_BATCH):
+        batch = [t[:MAX_CHARS] for t in texts[start:start + EMBED_BATCH]]
+        enc = tok(batch, padding='longest', truncation=True, max_length=MAX_TOKENS,
+                  return_tensors='np', return_token_type_ids=False)
+        if session is not None:
+            hidden = session.run(None, {
+                'input_ids': enc['input_ids'],
+                'attention_mask': enc['attention_mask'],
+            })[0]
+        else:
+            with torch.inference_mode():
+                out = mdl(**{k: torch.from_numpy(v).to(mdl.device) for k, v in enc.items()})
+            hidden = out.last_hidden_state.float().cpu().numpy()
+        # masked mean: padding positions contribute nothing to sum or count
+        mask = enc['attention_mask'].astype(np.float32)
+        summed = np.einsum('bsh,bs->bh', hidden, mask)
+        chunks.append(summed / np.maximum(mask.sum(axis=1, keepdims=True), 1.0))
+    if not chunks:
+        return np.empty((0, mdl.config.hidden_size), dtype=np.float32)
+    return np.concatenate(chunks)
 
 def main():
     # Load environment variables from a local .env file
@@ -165,7 +264,11 @@ def main():
             'folder_path': json.loads(os.getenv('MAIL_FOLDER_PATH', '[]')),
         },
         'analysis': {'top_n': int(os.getenv('TOP_N', '5'))},
-        'nlp':      {'model': os.getenv('NLP_MODEL', 'distilbert-base-uncased')},
+        'nlp':      {
+            'model': os.getenv('NLP_MODEL', 'distilbert-base-uncased'),
+            # INT8 ONNX Runtime inference when onnxruntime is installed
+            'onnx':  os.getenv('NLP_ONNX', '1') == '1',
+        },
         'meta':     {'git_sha': os.getenv('GIT_SHA', '')},
     }
 
@@ -181,18 +284,43 @@ def main():
     emails = asyncio.run(fetch_inbox(cfg, user_id=user_id))
 
     # NLP embedding
-    tok = AutoTokenizer.from_pretrained(cfg['nlp']['model'])
-    mdl = AutoModel.from_pretrained(cfg['nlp']['model'])
+    tok = AutoTokenizer.from_pretrained(cfg['nlp']['model'], use_fast=True)
+    if tok.pad_token is None:
+        tok.pad_token = tok.eos_token
+    # FP16 on a CUDA GPU when there is one; otherwise FP32 (or INT8 ONNX) on CPU
+    cuda = torch.cuda.is_available()
+    mdl = AutoModel.from_pretrained(
+        cfg['nlp']['model'],
+        torch_dtype=torch.float16 if cuda else torch.float32,
+    ).to('cuda' if cuda else 'cpu').eval()
     texts = [e.body for e in emails]
-    enc = tok(texts, return_tensors='pt', padding=True, truncation=True)
-    out = mdl(**enc)
-    embs = out.last_hidden_state.mean(dim=1).detach().numpy()
+    sess = None
+    if ort is not None and cfg['nlp']['onnx'] and not cuda:
+        onnx_path = os.path.join(script_dir, cfg['nlp']['model'].replace('/', '_') + '.onnx')
+        sample = tok(['sample'], return_tensors='np', return_token_type_ids=False)
+        sess = onnx_session(mdl, sample, onnx_path)
+    # embed each distinct body once; forwards and templated mail repeat verbatim
+    unique_texts = list(dict.fromkeys(texts))
+    position = {t: i for i, t in enumerate(unique_texts)}
+    inverse = np.fromiter((position[t] for t in texts), dtype=np.intp, count=len(texts))
+    embs = embed_texts(tok, mdl, unique_texts, session=sess)[inverse]
+    logger.info("Embedded message bodies", total=len(texts), unique=len(unique_texts))
     # perform clustering on the embeddings (if available)
     if hdbscan is None:
         logger.warning("hdbscan not available; skipping clustering step")
         clusters = np.zeros(len(embs), dtype=int)
+    elif len(embs) < MIN_CLUSTER_SIZE:
+        logger.warning("Too few messages to cluster; skipping clustering step", count=len(embs))
+        clusters = np.zeros(len(embs), dtype=int)
     else:
-        clusters = hdbscan.HDBSCAN(min_cluster_size=5).fit_predict(embs)
+        # cluster in a low-dimensional projection, where kd-tree search works
+        dims = min(CLUSTER_DIMS, *embs.shape)
+        red = PCA(n_components=dims, svd_solver='randomized').fit_transform(embs.astype(np.float32))
+        clusters = hdbscan.HDBSCAN(
+            min_cluster_size=MIN_CLUSTER_SIZE,
+            algorithm='boruvka_kdtree',
+            core_dist_n_jobs=-1,
+        ).fit_predict(red)
         logger.info("Clusters discovered", clusters=np.unique(clusters))
 
     # Game-theory / MDP stub (only if pymdptoolbox is installed)
@@ -201,8 +329,8 @@ def main():
     else:
         # placeholder P, R to demonstrate usage
         n_states, n_actions = 5, 2
-        P = [[[1.0 / n_states for _ in range(n_states)] for _ in range(n_states)] for _ in range(n_actions)]
-        R = [[0.0 for _ in range(n_states)] for _ in range(n_actions)]
+        P = np.full((n_actions, n_states, n_states), 1.0 / n_states)
+        R = np.zeros((n_states, n_actions))  # mdptoolbox wants R as (S, A)
         vi = ValueIteration(P, R, discount=0.95)
         vi.run()
         logger.info("Computed MDP policy", policy=vi.policy.tolist())
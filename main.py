@@ -1,6 +1,7 @@
 import sys
 import io
 import traceback
+import numpy as np
 from colorama import init as _colorama_init, Fore
 from asana_outlook_integration_script import main as run
 
@@ -15,10 +16,13 @@ class BinaryWriter:
     def write(self, text: str):
         # record for later replay
         self.buffer.write(text)
-        for ch in text:
-            bits = format(ord(ch), "08b")
-            for bit in bits:
-                self.real.write(Fore.GREEN + bit + "\n")
+        if not text:
+            return
+        # every bit of the UTF-8 bytes becomes a "0"/"1" line, in one write
+        bits = np.unpackbits(np.frombuffer(text.encode("utf-8"), dtype=np.uint8))
+        lines = np.full((bits.size, 2), ord("\n"), dtype=np.uint8)
+        lines[:, 0] = bits + ord("0")
+        self.real.write(Fore.GREEN + lines.tobytes().decode("ascii"))
         self.real.flush()
 
     def flush(self):